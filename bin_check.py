@@ -1,75 +1,163 @@
+import json
+import logging
+import mmap
+import os
 import struct
-import array
 import numpy as np
-import matplotlib.pyplot as plt
 
-import ROOT
+# per-event header: event number, timestamp, number of samples, time resolution
+_HDR = struct.Struct("<IQIQ")
+# raw mode header additionally carries the ADC scale and offset, samples are uint16 ADC counts
+_RAW_HDR = struct.Struct("<IQIQdd")
 
-plt.rcParams["figure.figsize"] = (12,10)
+def read_meta(input_raw_file):
+    # meta.json written by the acquisition next to the files, None for runs that predate it
+    meta_file = os.path.join(os.path.dirname(input_raw_file), 'meta.json')
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
 
 class Event:
-    def __init__(self, event_number, timestamp, nSamples, time_resolution, waveform):
+    def __init__(self, event_number, timestamp, nSamples, time_resolution, waveform, adc_scale=None, adc_offset=None):
         self.EventNumber = event_number
         self.Timestamp = timestamp
         self.NSamples = nSamples
         self.TimeResolution = time_resolution
         # self.Channel = channel
         self.Waveform = waveform
+        self.ADCScale = adc_scale
+        self.ADCOffset = adc_offset
+
+    @property
+    def WaveformMV(self):
+        # raw mode waveforms are ADC counts, converted only when asked for
+        if self.ADCScale is None:
+            return self.Waveform
+        return self.Waveform.astype(np.float32) * np.float32(self.ADCScale) + np.float32(self.ADCOffset)
 
 class ReadRawFile:
-    def __init__(self, input_raw_file):
+    def __init__(self, input_raw_file, raw_mode=False):
         self.input_raw_file = input_raw_file
+        self.raw_mode = raw_mode
+        if raw_mode:
+            self._hdr = _RAW_HDR
+            self.sample_dtype = np.dtype('<u2')
+        else:
+            self._hdr = _HDR
+            self.sample_dtype = np.dtype('<f4')
+
+    def _map_file(self):
+        fd = os.open(self.input_raw_file, os.O_RDONLY)
+        try:
+            if os.fstat(fd).st_size == 0:
+                return None
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd) # the mapping keeps its own reference to the file
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        return mm
 
     def read_raw_data(self):
-        with open(self.input_raw_file, 'rb') as myfile:
-            while True:
-                try:
-                    event_number = struct.unpack("<I", myfile.read(4))[0]
-                    myfile.seek(0, 1)
-                    timestamp = struct.unpack("<Q", myfile.read(8))[0]
-                    myfile.seek(0, 1)
-                    nSamples = struct.unpack("<I", myfile.read(4))[0]
-                    myfile.seek(0, 1)
-                    time_resolution = struct.unpack("<Q", myfile.read(8))[0]
-                    # myfile.seek(0, 1)
-                    # channel = struct.unpack("<i", myfile.read(4))[0]
-                    wf = []
-                    for _ in range(nSamples): # this is 2ms record length. 125000 is 1ms
-                        myfile.seek(0, 1)
-                        wf.append(struct.unpack("<f", myfile.read(4))[0])
-
-                    waveform = array.array('f', wf)
-
-                    # event_object = Event(event_number, timestamp, nSamples, time_resolution, channel, waveform)
-                    event_object = Event(event_number, timestamp, nSamples, time_resolution, waveform)
-
-                    yield event_object  
-                except struct.error:
+        mm = self._map_file()
+        if mm is None:
+            return
+        hdr = self._hdr
+        itemsize = self.sample_dtype.itemsize
+        off = 0
+        while off + hdr.size <= len(mm):
+            event_number, timestamp, nSamples, time_resolution, *adc = hdr.unpack_from(mm, off)
+            off += hdr.size
+            if off + itemsize*nSamples > len(mm):
+                break
+
+            # waveform is a view into the mapping, no data is copied
+            waveform = np.frombuffer(mm, dtype=self.sample_dtype, count=nSamples, offset=off) # this is 2ms record length. 125000 is 1ms
+            off += itemsize*nSamples
+
+            # event_object = Event(event_number, timestamp, nSamples, time_resolution, channel, waveform)
+            event_object = Event(event_number, timestamp, nSamples, time_resolution, waveform, *adc)
+
+            yield event_object
+
+    def timestamps_only(self):
+        mm = self._map_file()
+        if mm is None:
+            return
+        hdr = self._hdr
+        itemsize = self.sample_dtype.itemsize
+        try:
+            off = 0
+            while off + hdr.size <= len(mm):
+                _, timestamp, nSamples, *_ = hdr.unpack_from(mm, off)
+                off += hdr.size + itemsize*nSamples
+                if off > len(mm):
                     break
+                yield timestamp
+        finally:
+            mm.close()
+
+    def _record_dtype(self, nSamples):
+        # layout of one whole record (header + waveform) when the record length is nSamples
+        fields = [('evt', '<u4'), ('ts', '<u8'), ('n', '<u4'), ('tr', '<u8')]
+        if self.raw_mode:
+            fields += [('scale', '<f8'), ('offset', '<f8')]
+        return np.dtype(fields + [('wf', self.sample_dtype, (nSamples,))])
+
+    def iter_events_fixed(self, nSamples):
+        mm = self._map_file()
+        if mm is None:
+            return
+        # the whole file is one structured array, events are just rows of it
+        dt = self._record_dtype(nSamples)
+        arr = np.frombuffer(mm, dtype=dt, count=len(mm) // dt.itemsize)
+        if not np.all(arr['n'] == nSamples):
+            raise ValueError(f"{self.input_raw_file} does not have a constant record length of {nSamples} samples")
+        evt, ts, tr = arr['evt'].tolist(), arr['ts'].tolist(), arr['tr'].tolist()
+        wf = arr['wf']
+        if self.raw_mode:
+            scale, offset = arr['scale'].tolist(), arr['offset'].tolist()
+        for k in range(arr.size):
+            adc = (scale[k], offset[k]) if self.raw_mode else ()
+            yield Event(evt[k], ts[k], nSamples, tr[k], wf[k], *adc)
+
+    def read_timestamps_fast(self):
+        mm = self._map_file()
+        if mm is None or len(mm) < self._hdr.size:
+            return np.empty(0)
+        # every record has the same length, so the whole file can be viewed as one structured array
+        nSamples = self._hdr.unpack_from(mm, 0)[2]
+        dt = self._record_dtype(nSamples)
+        arr = np.frombuffer(mm, dtype=dt, count=len(mm) // dt.itemsize)
+        if not np.all(arr['n'] == nSamples):
+            # record length changed within the file, fall back to walking the headers
+            ts = np.fromiter(self.timestamps_only(), dtype=np.uint64)
+        else:
+            ts = arr['ts']
+        return ts.astype(np.float64) * (8.0/1e9)
+
 def main():
+    import matplotlib.pyplot as plt # only needed for plotting, keeps the reader cheap to import
+    plt.rcParams["figure.figsize"] = (12,10)
 
     input_raw_file = 'raw_CH10.bin'
 
-    events = ReadRawFile(input_raw_file) # build event from raw file
-    counter=0
-    timestamp_array = []
-    for ievent in events.read_raw_data(): # loop over all the events
-        print(f"EventNumber: {ievent.EventNumber}")
-        print(f"Timestamp: {ievent.Timestamp}")
-        print(f"Num Samples: {ievent.NSamples}")
-        print(f"TimeResolution: {ievent.TimeResolution}")
-
-        print("-------------")
-        
-        timestamp_array.append(ievent.Timestamp*8/10**9)
-        
-        
-        # if counter==2:break
-        # counter+=1
+    meta = read_meta(input_raw_file)
+    raw_mode = bool(meta and meta.get('raw_mode')) # file format as recorded by the acquisition
+    events = ReadRawFile(input_raw_file, raw_mode=raw_mode) # build event from raw file
+
+    # per-event listing is a debug trace, only walked when DEBUG logging is on
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for ievent in events.read_raw_data():
+            logging.debug("EventNumber: %d Timestamp: %d Num Samples: %d TimeResolution: %d",
+                          ievent.EventNumber, ievent.Timestamp, ievent.NSamples, ievent.TimeResolution)
+
+    ts = events.read_timestamps_fast() # timestamps in seconds for all the events
 
     myBins = np.linspace(0,120, 121)
     print(myBins)
-    plt.hist(np.array(timestamp_array),myBins)
+    plt.hist(ts, myBins)
     plt.grid(True)
     plt.xlabel("Time in seconds")
     plt.ylabel("Number of events per second ==> bin width of 1 second")
@@ -1,5 +1,6 @@
-import copy
+import json
 import logging
+import os
 import struct
 import numpy as np
 import queue
@@ -8,11 +9,61 @@ import time
 import sys
 from caen_felib import device
 from config import ConfigReader
+from spsc_queue import SPSCQueue
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 logging.basicConfig(level=logging.INFO)
 
+# Number of preallocated acquisition buffers shared by the acquisition and save threads
+QUEUE_DEPTH = 4
+
+# Each save thread collects records in memory and writes them out once this many bytes are pending
+BATCH_BYTES = 4 << 20
+
+# Sidecar describing how the raw_CH*.bin files of a run were written
+META_FILE = "meta.json"
+
+
+if njit is not None:
+    # Serial but GIL-free: every channel's save thread converts its own row concurrently
+    @njit(nogil=True, fastmath=True, cache=True)
+    def _adc_to_mv_kernel(src_u16, dst_f32, scale, offset):
+        """Convert ADC counts to mV in one pass: read uint16 once, write float32 once."""
+        for i in range(src_u16.size):
+            dst_f32[i] = src_u16[i] * scale + offset
+else:
+    def _adc_to_mv_kernel(src_u16, dst_f32, scale, offset):
+        """NumPy fallback when numba is not installed, still without temporaries."""
+        np.multiply(src_u16, scale, out=dst_f32, dtype=np.float32)
+        dst_f32 += offset
+
+
+class AcqRecord:
+    """Handoff record for one acquisition, its arrays live in a ring slot."""
+    __slots__ = ("trigger_num", "timestamp", "waveforms", "waveform_sizes", "ring_idx")
+
+    def __init__(self, trigger_num, timestamp, waveforms, waveform_sizes, ring_idx):
+        self.trigger_num = trigger_num
+        self.timestamp = timestamp
+        self.waveforms = waveforms
+        self.waveform_sizes = waveform_sizes
+        self.ring_idx = ring_idx
+
+
 class DataAcquisition:
-    def __init__(self, dig, adc_n_bits: int, config_reader):
+    # Per-channel event header: trigger id, timestamp, number of samples, time resolution
+    _HDR = struct.Struct("<IQIQ")
+    # Raw mode header additionally stores the ADC scale and offset to convert counts to mV
+    _RAW_HDR = struct.Struct("<IQIQdd")
+
+    def __init__(
+        self, dig, adc_n_bits: int, config_reader,
+        raw_mode: bool = False, verbose: bool = None, pin_threads: bool = False,
+    ):
         """
         Initialize the data acquisition.
 
@@ -20,13 +71,33 @@ class DataAcquisition:
             dig (object): CAEN digitizer device instance
             adc_n_bits (int): ADC bit resolution
             config_reader (ConfigReader): Instance of ConfigReader with configuration settings
+            raw_mode (bool): Save uint16 ADC counts instead of float32 mV
+            verbose (bool): Emit the per-trigger trace and save loop timing at DEBUG level.
+                Defaults to whether DEBUG logging is enabled; True also enables it
+            pin_threads (bool): Pin the acquisition and each save thread to its own CPU core (Linux only)
         """
         self.dig = dig
         self.adc_n_bits = adc_n_bits
         self.config = config_reader
+        self.raw_mode = raw_mode
+        # The trace goes through logging.debug, so verbose and the DEBUG level go together
+        if verbose is None:
+            verbose = logging.getLogger().isEnabledFor(logging.DEBUG)
+        elif verbose and not logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.getLogger().setLevel(logging.DEBUG)
+        self.verbose = verbose
+
+        # CPUs the threads get spread over, taken before any thread narrows its own affinity
+        self._cpus = None
+        if pin_threads and hasattr(os, "sched_setaffinity"):
+            self._cpus = sorted(os.sched_getaffinity(0))
         
         # Get acquisition settings from config
         self.acq_settings = self.config.get_acquisition_settings()
+
+        # Hardware and record length are fixed for the whole run, read them once
+        self._n_ch = int(self.dig.par.NUMCH.value)
+        self._record_length = self.acq_settings.record_length
         
         self.data_format = [
             {"name": "TRIGGER_ID", "type": "U32"},
@@ -36,28 +107,55 @@ class DataAcquisition:
                 "type": "U16",
                 "dim": 2,
                 "shape": [
-                    int(self.dig.par.NUMCH.value),
-                    self.acq_settings.record_length,
+                    self._n_ch,
+                    self._record_length,
                 ],
             },
             {
                 "name": "WAVEFORM_SIZE",
                 "type": "U64",
                 "dim": 1,
-                "shape": [int(self.dig.par.NUMCH.value)],
+                "shape": [self._n_ch],
             },
         ]
 
-        self.acquisition_queue = queue.Queue()
-        self.save_queue = queue.Queue()
+        # One queue per channel save thread. Bounded so a slow disk turns into backpressure on
+        # the digitizer reads instead of unbounded memory growth; it costs nothing while the
+        # save threads keep up, at the price of stalling acquisition when they don't.
+        # The extra entry is room for the None sentinel.
+        self.ch_queues = [SPSCQueue(maxsize=QUEUE_DEPTH + 1) for _ in range(self._n_ch)]
         self.stop_event = threading.Event()
         
         # Set up data format for digitizer
         self.data = self.dig.endpoint.scope.set_read_data_format(self.data_format)
 
-        # ADC conversion parameters
-        self.adc_scale = 2.0 / (2**self.adc_n_bits - 1)
-        self.adc_offset = -1.0
+        # The conversion and raw writes assume uint16 samples; check once instead of per trigger
+        if self.data[2].value.dtype != np.uint16:
+            raise RuntimeError(
+                f"Unexpected waveform dtype from digitizer: {self.data[2].value.dtype}"
+            )
+
+        # ADC conversion parameters, float32 so the conversion never promotes to float64
+        self.adc_scale = np.float32(2.0 / (2**self.adc_n_bits - 1))
+        self.adc_offset = np.float32(-1.0)
+
+        # Ring of read buffers; slot indices travel through the free queue. Each slot is a
+        # full set of felib Data with the same layout, so read_data fills a slot directly
+        self._data_ring = [self.data] + [
+            tuple(device.Data(**f) for f in self.data_format)
+            for _ in range(QUEUE_DEPTH - 1)
+        ]
+        # All save threads return slots here; _slot_lock is what keeps free_queue single-producer,
+        # so never call free_queue.put outside it
+        self.free_queue = SPSCQueue(maxsize=QUEUE_DEPTH)
+        for k in range(QUEUE_DEPTH):
+            self.free_queue.put(k)
+        # A slot is free again once every channel's save thread is done with it
+        self._slot_refs = [0] * QUEUE_DEPTH
+        self._slot_lock = threading.Lock()
+
+        # Headers and samples are packed straight into each save thread's batch buffer
+        self._hdr = DataAcquisition._RAW_HDR if self.raw_mode else DataAcquisition._HDR
         
         # Apply settings to the digitizer
         self.set_settings()
@@ -66,137 +164,235 @@ class DataAcquisition:
         """Set the digitizer settings based on the configuration file."""
         try:
             # Set acquisition parameters from configuration
-            self.dig.par.RECORDLENGTHT.value = str(self.acq_settings.record_length)
+            self.dig.par.RECORDLENGTHT.value = str(self._record_length)
             self.dig.par.PRETRIGGERT.value = str(self.acq_settings.pretrigger)
             self.dig.par.AcqTriggerSource.value = self.acq_settings.acq_trigger_source
             self.dig.par.ITLAMASK.value = self.acq_settings.trigger_mask
+
+            # Channel enable mask parsed once, not once per channel
+            self._channel_mask_int = int(self.acq_settings.selected_channels, 16)
         
-            for i in range(int(self.dig.par.NUMCH.value)):
+            for i in range(self._n_ch):
                 channel_settings = self.config.get_channel_settings(i)
                 self.dig.ch[i].par.DCOffset.value = str(channel_settings.dc_offset)
                 self.dig.ch[i].par.TriggerThr.value = str(channel_settings.threshold)
-                self.dig.ch[i].par.chenable.value = self.check_mask(self.acq_settings.selected_channels, i)
+                self.dig.ch[i].par.chenable.value = self.check_mask(i)
 
         except Exception as e:
             raise RuntimeError(f"Error applying settings to digitizer: {e}")
 
-    def adc_to_mv(self, adc_array: np.ndarray) -> np.ndarray:
+    def _pin_thread(self, channel: int = None):
         """
-        Convert ADC values to millivolts using vectorized operations.
-        
-        Parameters:
-            adc_array (np.ndarray): Array of ADC values
-            
-        Returns:
-            np.ndarray: Array of voltage values in millivolts
+        Pin the calling thread to its core, if enabled.
+
+        The acquisition thread (channel None) gets the first available CPU. Save threads are
+        spread over the remaining ones, so they only share the acquisition core on a
+        single-CPU host.
         """
-        return adc_array.astype(np.float32) * self.adc_scale + self.adc_offset
+        cpus = self._cpus
+        if cpus is None:
+            return
+        if channel is None or len(cpus) == 1:
+            core = cpus[0]
+        else:
+            core = cpus[1 + channel % (len(cpus) - 1)]
+        try:
+            # pid 0 is the calling thread on Linux
+            os.sched_setaffinity(0, {core})
+        except OSError as e:
+            logging.warning("Could not pin thread to core %d: %s", core, e)
+            return
+        logging.debug("[THREAD] Thread %s pinned to core %d", threading.get_ident(), core)
 
     def acquisition_thread(self):
         """Thread for acquiring data from the digitizer."""
         self.acquisition_thread_id = threading.get_ident()
         logging.debug(
-            f"[THREAD] Acquisition thread started. Thread ID: {self.acquisition_thread_id}"
+            "[THREAD] Acquisition thread started. Thread ID: %s", self.acquisition_thread_id
         )
         try:
             self.dig.cmd.ArmAcquisition()
             self.dig.cmd.SwStartAcquisition()
+            # Pinned only now: native threads the library starts from the calls above would
+            # otherwise inherit this thread's single-core mask
+            self._pin_thread()
 
+            verbose = self.verbose
             acq_count = 0
             while not self.stop_event.is_set():
-                logging.debug(f"[THREAD] Starting acquisition {acq_count + 1}")
-
-                self.dig.cmd.SendSwTrigger()
-                self.dig.endpoint.scope.read_data(-1, self.data)
+                # Wait for a free ring slot, re-checking stop_event while the save threads are busy
+                try:
+                    k = self.free_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
 
-                acquisition_data = {
-                    "trigger_num": copy.deepcopy(self.data[0].value),
-                    "timestamp": copy.deepcopy(self.data[1].value),
-                    "waveforms": copy.deepcopy(self.data[2].value),
-                    "waveform_sizes": copy.deepcopy(self.data[3].value),
-                }
+                if verbose:
+                    logging.debug("[THREAD] Starting acquisition %d", acq_count + 1)
 
-                self.acquisition_queue.put(acquisition_data)
+                # The digitizer writes straight into the free slot, nothing is copied afterwards
+                data = self._data_ring[k]
+                self.dig.cmd.SendSwTrigger()
+                self.dig.endpoint.scope.read_data(-1, data)
+
+                rec = AcqRecord(
+                    int(data[0].value),
+                    int(data[1].value),
+                    data[2].value,
+                    data[3].value,
+                    k,
+                )
+                self._slot_refs[k] = self._n_ch
+                for ch_queue in self.ch_queues:
+                    ch_queue.put(rec)
                 acq_count += 1
-
-            self.acquisition_queue.put(None)
             
         except Exception as e:
             print(f"Error in acquisition thread: {e}")
             self.stop_event.set()
         finally:
+            # Always send the sentinel, the save threads block on their queues until it arrives
+            for ch_queue in self.ch_queues:
+                ch_queue.put(None)
             self.dig.cmd.DisarmAcquisition()
 
-    def save_thread(self):
-        """Thread for saving waveform data to files with optimized writing."""
-        self.save_thread_id = threading.get_ident()
-        logging.debug(f"[THREAD] Save thread started. Thread ID: {self.save_thread_id}")
-
-        file_handles = {}
+    def save_thread(self, channel: int):
+        """Thread converting and saving the waveforms of one channel to its own file."""
+        logging.debug(
+            "[THREAD] Save thread for channel %d started. Thread ID: %s",
+            channel, threading.get_ident(),
+        )
+        self._pin_thread(channel)
+
+        # Loop invariants pulled into locals so the loop skips attribute lookups
+        ch_queue = self.ch_queues[channel]
+        verbose = self.verbose
+        raw_mode = self.raw_mode
+        hdr = self._hdr
+        hdr_size = hdr.size
+        record_length = self._record_length
+        itemsize = 2 if raw_mode else 4
+        adc_scale = self.adc_scale
+        adc_offset = self.adc_offset
+
+        # Pending records are written out in one go once BATCH_BYTES is reached, the spare
+        # room past the threshold always fits one more full record
+        batch = bytearray(BATCH_BYTES + hdr_size + record_length * itemsize)
+        fill = 0
+
+        if raw_mode:
+            # Byte views of this channel's row in every ring slot, sliced instead of the arrays
+            ring_rows = [memoryview(slot[2].value[channel]).cast("B") for slot in self._data_ring]
+        else:
+            # float32 view of the whole batch; header plus float32 samples keep fill a
+            # multiple of 4, so every payload starts on a float32 index
+            batch_f32 = np.frombuffer(batch, dtype=np.float32, count=len(batch) // 4)
+
+        fd = None
         try:
-            # Initialize file handles for each channel with buffering
-            for i in range(len(self.data[2].value)):
-                filename = f"raw_CH{i}.bin"
-                file_handles[i] = open(filename, "ab", buffering=8192)  # 8KB buffer
+            # Raw append-only descriptor, each batch goes out in a single write
+            flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0)
+            fd = os.open(f"raw_CH{channel}.bin", flags, 0o644)
 
-            while not self.stop_event.is_set():
-                try:
-                    acquisition_data = self.acquisition_queue.get(timeout=1)
-                    if acquisition_data is None:
-                        break
-
-                    logging.debug(
-                        f"[THREAD] Saving data from trigger {acquisition_data['trigger_num']}"
-                    )
-                    start_time = time.time()
-
-                    # Get data from the acquisition
-                    trigger_num = acquisition_data["trigger_num"]
-                    timestamp = acquisition_data["timestamp"]
-                    waveforms = np.array(acquisition_data["waveforms"])
-                    waveform_sizes = acquisition_data["waveform_sizes"]
-                    
-                    # Process each channel
-                    for i, waveform in enumerate(waveforms):
-                        f = file_handles[i]
-                        size = waveform_sizes[i]
-
-                        # Pack header data directly
-                        f.write(struct.pack("I", trigger_num))
-                        f.write(struct.pack("Q", timestamp))
-                        f.write(struct.pack("I", size))
-                        f.write(struct.pack("Q", 8))  # time resolution
-
-                        # Convert and write waveform data
-                        waveform_mv = self.adc_to_mv(waveform[:size])
-                        waveform_mv.tofile(f)
-
-                        # Flush every 10 acquisitions
-                        if trigger_num % 10 == 0:
-                            f.flush()
-
-                    end_time = time.time()
-                    loop_duration = end_time - start_time
-                    logging.debug(f"[THREAD] Save loop took {loop_duration:.4f} seconds")
+            # Runs until the acquisition thread's None sentinel, draining anything still queued
+            while True:
+                rec = ch_queue.get()
+                if rec is None:
+                    break
 
-                except queue.Empty:
-                    continue
-                except Exception as e:
-                    print(f"Error processing acquisition: {e}")
-                    raise
+                try:
+                    # Trace and timing only run when asked for
+                    if verbose:
+                        logging.debug(
+                            "[THREAD] Saving channel %d of trigger %d", channel, rec.trigger_num
+                        )
+                        start_ns = time.perf_counter_ns()
+
+                    size = int(rec.waveform_sizes[channel])
+
+                    # Pack header at the end of the batch, time resolution is 8 ns
+                    if raw_mode:
+                        hdr.pack_into(
+                            batch, fill, rec.trigger_num, rec.timestamp, size, 8,
+                            adc_scale, adc_offset,
+                        )
+                    else:
+                        hdr.pack_into(batch, fill, rec.trigger_num, rec.timestamp, size, 8)
+                    # fill only moves past a record once it is complete, so a failure halfway
+                    # through never leaves a header without its samples in the batch
+                    pos = fill + hdr_size
+
+                    # Samples land right behind their header, no intermediate buffer.
+                    # Full-length records, the usual case, skip slicing the source
+                    nbytes = size * itemsize
+                    if raw_mode:
+                        # ADC counts as they are, conversion is left to the reader
+                        row = ring_rows[rec.ring_idx]
+                        batch[pos:pos + nbytes] = row if size == record_length else row[:nbytes]
+                    else:
+                        waveform = rec.waveforms[channel]
+                        if size != record_length:
+                            waveform = waveform[:size]
+                        start = pos >> 2
+                        _adc_to_mv_kernel(
+                            waveform, batch_f32[start:start + size], adc_scale, adc_offset
+                        )
+                    fill = pos + nbytes
+
+                    if verbose:
+                        dur_us = (time.perf_counter_ns() - start_ns) // 1000
+                        logging.debug(
+                            "[THREAD] Save loop for channel %d took %d us", channel, dur_us
+                        )
+                finally:
+                    # The samples are copied out, the slot can go back right away
+                    self._release_slot(rec.ring_idx)
+
+                if fill >= BATCH_BYTES:
+                    # Cleared first, a failed write is not repeated by the final flush
+                    pending, fill = fill, 0
+                    self._write_all(fd, memoryview(batch)[:pending])
 
         except Exception as e:
-            print(f"Error in save thread: {e}")
+            print(f"Error in save thread for channel {channel}: {e}")
             self.stop_event.set()
+            # Keep consuming up to the sentinel so the acquisition thread never blocks on this queue
+            rec = ch_queue.get()
+            while rec is not None:
+                self._release_slot(rec.ring_idx)
+                rec = ch_queue.get()
         finally:
-            for f in file_handles.values():
-                f.flush()
-                f.close()
-
-    def check_mask(self, mask, channel):
-        mask = int(mask, 16)
-        result = (mask & (1 << channel)) != 0
-        return str(result)
+            if fd is not None:
+                # Whatever is still pending, also the complete records batched before a failure
+                try:
+                    if fill:
+                        self._write_all(fd, memoryview(batch)[:fill])
+                except OSError as e:
+                    print(f"Error flushing channel {channel}: {e}")
+                finally:
+                    os.close(fd)
+
+    def _release_slot(self, k: int):
+        """
+        Drop one channel's hold on ring slot k, the last one returns it to the free queue.
+
+        The put happens under _slot_lock, which is what keeps free_queue single-producer;
+        never call free_queue.put outside it.
+        """
+        with self._slot_lock:
+            self._slot_refs[k] -= 1
+            if self._slot_refs[k] == 0:
+                self.free_queue.put(k)
+
+    @staticmethod
+    def _write_all(fd, buf):
+        """Write buf to fd completely, straight from its memory, retrying partial writes."""
+        view = memoryview(buf).cast("B")
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+    def check_mask(self, channel):
+        return str(bool(self._channel_mask_int & (1 << channel)))
     
     def print_settings(self):
         print("Current settings:")
@@ -204,27 +400,86 @@ class DataAcquisition:
         print(f"Pretrigger: {self.dig.par.PRETRIGGERT.value}")
         print(f"Acquisition trigger source: {self.dig.par.AcqTriggerSource.value}")
         print(f"Trigger mask: {self.dig.par.ITLAMask.value}")
-        for i in range(int(self.dig.par.NUMCH.value)):
+        for i in range(self._n_ch):
             print(f"Channel {i}:")
             print(f"DC offset: {self.dig.ch[i].par.DCOffset.value}")
             print(f"Threshold: {self.dig.ch[i].par.TriggerThr.value}")
             print(f"Channel enabled: {self.dig.ch[i].par.chenable.value}")
        
+    def write_meta(self):
+        """Write the sidecar a reader needs to decode the files, including the ADC-to-mV conversion."""
+        meta = {
+            "raw_mode": self.raw_mode,
+            "sample_dtype": "<u2" if self.raw_mode else "<f4",
+            "adc_n_bits": self.adc_n_bits,
+            "adc_scale": float(self.adc_scale),
+            "adc_offset": float(self.adc_offset),
+            # Informational, the record length of the latest run; headers hold the real counts
+            "record_length": self._record_length,
+        }
+        self._check_appendable(meta)
+        with open(META_FILE, "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def _check_appendable(self, meta: dict):
+        """
+        Refuse to run when the existing raw_CH*.bin were written in another format.
+
+        The files are opened for appending, so records of a different layout would end up
+        in the same file and the new sidecar would describe only part of it.
+        """
+        existing = [
+            name for name in (f"raw_CH{i}.bin" for i in range(self._n_ch))
+            if os.path.isfile(name) and os.path.getsize(name) > 0
+        ]
+        if not existing:
+            return
+
+        if os.path.isfile(META_FILE):
+            with open(META_FILE) as f:
+                previous = json.load(f)
+        else:
+            # Files from before the sidecar existed, the reader takes them as float32
+            previous = {"raw_mode": False, "sample_dtype": "<f4"}
+
+        # Only the record layout matters; every header carries its own sample count, so a
+        # changed record_length appends fine and the reader copes with mixed lengths
+        changed = [
+            key for key in ("raw_mode", "sample_dtype")
+            if key in previous and previous[key] != meta[key]
+        ]
+        if changed:
+            raise RuntimeError(
+                f"{', '.join(existing)} were written with a different {', '.join(changed)} "
+                f"({', '.join(f'{k}={previous[k]}' for k in changed)}); "
+                "move or remove them before starting this run"
+            )
+
     def run(self) -> bool:
         """
         Run the data acquisition and saving process using threads.
         
         Returns:
             bool: True if acquisition completed successfully, False otherwise
+
+        Raises:
+            RuntimeError: If existing raw_CH*.bin files were written in another format
         """
+        # Outside the try: a format clash with existing files must stop the run, not be swallowed
+        self.write_meta()
+
         try:
             acq_thread = threading.Thread(target=self.acquisition_thread)
-            save_thread = threading.Thread(target=self.save_thread)
+            save_threads = [
+                threading.Thread(target=self.save_thread, args=(i,))
+                for i in range(self._n_ch)
+            ]
 
             acq_thread.start()
-            save_thread.start()
+            for save_thread in save_threads:
+                save_thread.start()
 
-            return acq_thread, save_thread  # Return threads for the main loop
+            return acq_thread, save_threads  # Return threads for the main loop
 
         except Exception as e:
             print(f"Error running acquisition: {e}")
@@ -283,18 +538,22 @@ def main():
         acquisition_manager = DataAcquisition(
             dig, 
             adc_n_bits=adc_n_bits,
-            config_reader=config_reader
+            config_reader=config_reader,
+            raw_mode=False,
+            # Off until measured on the real digitizer
+            pin_threads=False,
         )
 
         # Start acquisition and save threads
-        acq_thread, save_thread = acquisition_manager.run()
+        acq_thread, save_threads = acquisition_manager.run()
         
         # Start the input listener in the main thread
         listen_for_key(acquisition_manager)
 
         # Wait for threads to finish
         acq_thread.join()
-        save_thread.join()
+        for save_thread in save_threads:
+            save_thread.join()
 
         print("Acquisition process ended.")
 
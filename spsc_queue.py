@@ -0,0 +1,89 @@
+import queue
+import threading
+from typing import Any, Optional
+
+
+class SPSCQueue:
+    """
+    Bounded queue for exactly one producer thread and one consumer thread
+
+    Items live in a preallocated ring of slots. The producer only advances the
+    tail index and the consumer only advances the head index, so a put on a
+    non-full queue and a get on a non-empty queue take no lock at all. The
+    condition variable is only used when one side has to wait, or has to wake
+    up the other side that is waiting. Index updates rely on the GIL to be
+    seen by the other thread, in the order they are written.
+
+    Free-threaded (no-GIL) Python builds are not supported: without the GIL
+    the lock-free put/get path has no ordering guarantee and is unsound.
+
+    Raises queue.Full / queue.Empty on timeout, like queue.Queue.
+    """
+    def __init__(self, maxsize: int):
+        if maxsize < 1:
+            raise ValueError(f"Invalid queue size: {maxsize}")
+        # One spare slot so a full ring can be told apart from an empty one
+        self._n = maxsize + 1
+        self._slots = [None] * self._n
+        self._head = 0  # next slot to read, only moved by the consumer
+        self._tail = 0  # next slot to write, only moved by the producer
+        self._cond = threading.Condition(threading.Lock())
+        self._getter_waiting = False
+        self._putter_waiting = False
+
+    def _full(self) -> bool:
+        return (self._tail + 1) % self._n == self._head
+
+    def _empty(self) -> bool:
+        return self._head == self._tail
+
+    def _wait(self, is_blocked, timeout: Optional[float]) -> bool:
+        """Wait on the condition until is_blocked() turns false, False on timeout"""
+        if timeout is None:
+            while is_blocked():
+                self._cond.wait()
+            return True
+        return self._cond.wait_for(lambda: not is_blocked(), timeout)
+
+    def put(self, item: Any, timeout: Optional[float] = None) -> None:
+        """Add an item, blocking while the queue is full"""
+        tail = self._tail
+        nxt = (tail + 1) % self._n
+        if nxt == self._head:
+            with self._cond:
+                # Flag is raised before the re-check so the consumer cannot miss it
+                self._putter_waiting = True
+                try:
+                    if not self._wait(self._full, timeout):
+                        raise queue.Full
+                finally:
+                    self._putter_waiting = False
+
+        self._slots[tail] = item
+        self._tail = nxt
+
+        if self._getter_waiting:
+            with self._cond:
+                self._cond.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """Remove and return the oldest item, blocking while the queue is empty"""
+        head = self._head
+        if head == self._tail:
+            with self._cond:
+                # Flag is raised before the re-check so the producer cannot miss it
+                self._getter_waiting = True
+                try:
+                    if not self._wait(self._empty, timeout):
+                        raise queue.Empty
+                finally:
+                    self._getter_waiting = False
+
+        item = self._slots[head]
+        self._slots[head] = None  # do not keep the item alive from the ring
+        self._head = (head + 1) % self._n
+
+        if self._putter_waiting:
+            with self._cond:
+                self._cond.notify()
+        return item
@@ -0,0 +1,200 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import types
+import unittest
+
+import numpy as np
+
+try:
+    import caen_felib  # noqa: F401
+except ImportError:
+    # Only device.Data is used outside a connected digitizer, a plain array holder is enough
+    class _FakeData:
+        def __init__(self, name, type, dim=0, shape=()):
+            self.name = name
+            self.value = np.zeros(shape, dtype={"U16": np.uint16, "U32": np.uint32, "U64": np.uint64}[type])
+
+    _device = types.ModuleType("caen_felib.device")
+    _device.Data = _FakeData
+    _felib = types.ModuleType("caen_felib")
+    _felib.device = _device
+    sys.modules["caen_felib"] = _felib
+    sys.modules["caen_felib.device"] = _device
+
+import bin_check
+import main
+from caen_felib import device
+from config import ConfigReader
+
+N_CH = 3
+
+
+class _Param:
+    def __init__(self, value="0"):
+        self.value = value
+
+
+class _Params(dict):
+    def __getattr__(self, name):
+        return self.setdefault(name, _Param())
+
+
+class _Scope:
+    """Serves `events` triggers of size record_length - short, then stops the acquisition."""
+    def __init__(self, events, short):
+        self.events = events
+        self.short = short
+        self.n = 0
+        self.acq = None
+
+    def set_read_data_format(self, data_format):
+        return tuple(device.Data(**f) for f in data_format)
+
+    def read_data(self, timeout, data):
+        self.n += 1
+        n_ch, record_length = data[2].value.shape
+        data[0].value[...] = self.n
+        data[1].value[...] = self.n * 1000
+        data[2].value[...] = expected_counts(self.n, n_ch, record_length)
+        data[3].value[...] = record_length - self.short
+        if self.n >= self.events:
+            self.acq.stop_event.set()
+
+
+class _Dig:
+    def __init__(self, events, short):
+        self.par = _Params(NUMCH=_Param(str(N_CH)))
+        self.ch = [types.SimpleNamespace(par=_Params()) for _ in range(N_CH)]
+        self.cmd = types.SimpleNamespace(
+            ArmAcquisition=lambda: None, SwStartAcquisition=lambda: None,
+            SendSwTrigger=lambda: None, DisarmAcquisition=lambda: None,
+        )
+        self.endpoint = types.SimpleNamespace(scope=_Scope(events, short))
+
+
+def expected_counts(trigger, n_ch, record_length):
+    """Waveform pattern that differs per trigger and channel."""
+    return ((np.arange(record_length)[None, :] + 7 * np.arange(n_ch)[:, None] + trigger) % 16384).astype(np.uint16)
+
+
+class FileFormatTest(unittest.TestCase):
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def acquire(self, events, record_length=3000, short=3, **kwargs):
+        """Run a full acquisition against the fake digitizer and wait for every thread."""
+        defaults = {
+            "ACQ": {
+                "record_length": str(record_length), "pretrigger": "16", "acq_trigger_source": "SwTrg",
+                "trigger_mode": "Normal", "selected_channels": "0x7", "trigger_mask": "0x0",
+            },
+            "default_channel": {"dc_offset": "50", "threshold": "100"},
+        }
+        dig = _Dig(events, short)
+        cr = ConfigReader("no_settings.ini", defaults, N_CH)
+        acq = main.DataAcquisition(dig, adc_n_bits=14, config_reader=cr, **kwargs)
+        dig.endpoint.scope.acq = acq
+        acq_thread, save_threads = acq.run()
+        for t in [acq_thread] + save_threads:
+            t.join(timeout=60)
+            self.assertFalse(t.is_alive())
+        return acq
+
+    def check_channel(self, channel, acq, events, record_length, short):
+        meta = bin_check.read_meta(f"raw_CH{channel}.bin")
+        reader = bin_check.ReadRawFile(f"raw_CH{channel}.bin", raw_mode=meta["raw_mode"])
+        read = list(reader.read_raw_data())
+        self.assertEqual([e.EventNumber for e in read], list(range(1, events + 1)))
+        size = record_length - short
+        for e in read:
+            self.assertEqual((e.Timestamp, e.NSamples, e.TimeResolution), (e.EventNumber * 1000, size, 8))
+            counts = expected_counts(e.EventNumber, N_CH, record_length)[channel, :size]
+            mv = counts.astype(np.float32) * acq.adc_scale + acq.adc_offset
+            if meta["raw_mode"]:
+                np.testing.assert_array_equal(e.Waveform, counts)
+            np.testing.assert_allclose(e.WaveformMV, mv, rtol=0, atol=1e-6)
+        np.testing.assert_allclose(reader.read_timestamps_fast(), np.arange(1, events + 1) * 1000 * 8e-9)
+
+    def test_float_round_trip(self):
+        acq = self.acquire(20)
+        for channel in range(N_CH):
+            self.check_channel(channel, acq, 20, 3000, 3)
+
+    def test_raw_round_trip(self):
+        acq = self.acquire(20, raw_mode=True)
+        with open(main.META_FILE) as f:
+            meta = json.load(f)
+        self.assertEqual(
+            (meta["raw_mode"], meta["sample_dtype"], meta["adc_n_bits"], meta["adc_scale"], meta["adc_offset"]),
+            (True, "<u2", 14, float(acq.adc_scale), float(acq.adc_offset)),
+        )
+        for channel in range(N_CH):
+            self.check_channel(channel, acq, 20, 3000, 3)
+
+    def test_full_length_records(self):
+        for raw_mode in (False, True):
+            with self.subTest(raw_mode=raw_mode):
+                for channel in range(N_CH):
+                    if os.path.exists(f"raw_CH{channel}.bin"):
+                        os.remove(f"raw_CH{channel}.bin")
+                acq = self.acquire(3, record_length=300000, short=0, raw_mode=raw_mode)
+                for channel in range(N_CH):
+                    self.check_channel(channel, acq, 3, 300000, 0)
+
+    def test_format_clash_refused(self):
+        self.acquire(2)
+        with self.assertRaises(RuntimeError):
+            self.acquire(2, raw_mode=True)
+        # Nothing was appended by the refused run
+        self.assertEqual(os.path.getsize("raw_CH0.bin"), 2 * (main.DataAcquisition._HDR.size + 2997 * 4))
+
+    def test_record_length_change_appends(self):
+        self.acquire(2, record_length=3000)
+        self.acquire(2, record_length=2000)
+        reader = bin_check.ReadRawFile("raw_CH0.bin")
+        self.assertEqual([e.NSamples for e in reader.read_raw_data()], [2997, 2997, 1997, 1997])
+        self.assertEqual(len(reader.read_timestamps_fast()), 4)
+
+    def test_failing_save_thread_keeps_batched_records(self):
+        kernel = main._adc_to_mv_kernel
+        calls = {}
+        lock = threading.Lock()
+        failed = []
+
+        def failing_kernel(src, dst, scale, offset):
+            # The first save thread to reach its 40th record fails on it
+            with lock:
+                n = calls[threading.get_ident()] = calls.get(threading.get_ident(), 0) + 1
+                fail = n == 40 and not failed
+                if fail:
+                    failed.append(threading.get_ident())
+            if fail:
+                raise RuntimeError("conversion failed")
+            kernel(src, dst, scale, offset)
+
+        main._adc_to_mv_kernel = failing_kernel
+        try:
+            self.acquire(100)
+        finally:
+            main._adc_to_mv_kernel = kernel
+
+        counts = sorted(
+            len(list(bin_check.ReadRawFile(f"raw_CH{ch}.bin").read_raw_data())) for ch in range(N_CH)
+        )
+        # The failing channel still holds the 39 complete records it had batched, the
+        # others stop wherever the raised stop_event caught the acquisition
+        self.assertEqual(counts[0], 39)
+        self.assertTrue(all(n >= 39 for n in counts[1:]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import queue
+import random
+import threading
+import time
+import unittest
+
+from spsc_queue import SPSCQueue
+
+
+class SPSCQueueTest(unittest.TestCase):
+    N_ITEMS = 200_000
+
+    def _run_ordered(self, maxsize: int):
+        """One producer, one consumer, random short stalls on both sides to hit the wait paths."""
+        q = SPSCQueue(maxsize)
+        received = []
+        errors = []
+
+        def producer():
+            try:
+                for i in range(self.N_ITEMS):
+                    q.put(i)
+                    if random.random() < 0.0005:
+                        time.sleep(0.001)
+                q.put(None)
+            except Exception as e:
+                errors.append(e)
+
+        def consumer():
+            try:
+                while True:
+                    item = q.get()
+                    if item is None:
+                        break
+                    received.append(item)
+                    if random.random() < 0.0005:
+                        time.sleep(0.001)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=producer), threading.Thread(target=consumer)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=60)
+            self.assertFalse(t.is_alive(), f"queue of size {maxsize} deadlocked")
+
+        self.assertEqual(errors, [])
+        # Compared as a whole first so a failure does not print 200k items
+        self.assertTrue(received == list(range(self.N_ITEMS)), f"items lost or reordered at size {maxsize}")
+
+    def test_ordered_size_1(self):
+        self._run_ordered(1)
+
+    def test_ordered_size_2(self):
+        self._run_ordered(2)
+
+    def test_ordered_size_5(self):
+        self._run_ordered(5)
+
+    def test_get_timeout_raises_empty(self):
+        q = SPSCQueue(1)
+        with self.assertRaises(queue.Empty):
+            q.get(timeout=0.05)
+
+    def test_put_timeout_raises_full(self):
+        q = SPSCQueue(1)
+        q.put(1)
+        with self.assertRaises(queue.Full):
+            q.put(2, timeout=0.05)
+        # The failed put leaves the queue intact and usable
+        self.assertEqual(q.get(timeout=0.05), 1)
+        q.put(3, timeout=0.05)
+        self.assertEqual(q.get(timeout=0.05), 3)
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            SPSCQueue(0)
+
+
+if __name__ == "__main__":
+    unittest.main()